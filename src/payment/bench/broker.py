@@ -0,0 +1,168 @@
+import json
+import time
+import random
+import threading
+
+import pika
+
+
+class InMemoryBroker:
+    """In-process stand-in for RabbitMQ behind pika.BlockingConnection.
+
+    install() swaps the connection factory used by rabbitmq.Publisher so
+    every publisher in the process talks to this broker. Publishes on a
+    confirm channel are stored and acked together on the next
+    process_data_events, after latency_ms. With probability error_rate
+    the connection drops before they are stored, and with ack_loss_rate
+    it drops after they are stored but before the ack. With down set,
+    connecting fails outright, and drop() cuts every open connection.
+    """
+
+    def __init__(self, latency_ms=0, error_rate=0.0, ack_loss_rate=0.0, down=False):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.ack_loss_rate = ack_loss_rate
+        self.down = down
+        self.published = 0
+        self.errors = 0
+        self._orderids = set()
+        self.duplicates = 0
+        self._connections = []
+        self._lock = threading.Lock()
+        self._original = None
+
+    def install(self):
+        self._original = pika.BlockingConnection
+        pika.BlockingConnection = self.connect
+        return self
+
+    def uninstall(self):
+        if self._original is not None:
+            pika.BlockingConnection = self._original
+            self._original = None
+
+    def connect(self, params=None):
+        if self.down:
+            raise pika.exceptions.AMQPConnectionError('broker down')
+        connection = _Connection(self)
+        with self._lock:
+            self._connections = [c for c in self._connections if c.is_open]
+            self._connections.append(connection)
+        return connection
+
+    # Cut every open connection, as a broker restart or network blip would.
+    def drop(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            # like pika, the loss shows on the next process_data_events
+            connection.lost = True
+
+    def _fail(self, connection, reason):
+        self.errors += 1
+        connection.is_open = False
+        connection.is_closed = True
+        raise pika.exceptions.StreamLostError(reason)
+
+    # Store bodies, raising StreamLostError for injected failures.
+    def _deliver(self, connection, bodies):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        with self._lock:
+            if self.down or random.random() < self.error_rate:
+                self._fail(connection, 'injected broker error')
+            for body in bodies:
+                self.published += 1
+                orderid = json.loads(body).get('orderid')
+                if orderid in self._orderids:
+                    self.duplicates += 1
+                self._orderids.add(orderid)
+            if random.random() < self.ack_loss_rate:
+                self._fail(connection, 'injected ack loss')
+
+    def stats(self):
+        return {'published': self.published, 'errors': self.errors, 'duplicates': self.duplicates}
+
+
+class _Connection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.is_closed = False
+        self.lost = False
+        self._channels = []
+
+    def channel(self):
+        channel = _Channel(self)
+        self._channels.append(channel)
+        return channel
+
+    def process_data_events(self, time_limit=0):
+        if self.is_closed or self.lost or self.broker.down:
+            self.is_open = False
+            self.is_closed = True
+            raise pika.exceptions.StreamLostError('connection lost')
+        for channel in self._channels:
+            channel._impl._flush()
+
+    def call_later(self, delay, callback):
+        pass
+
+    def close(self):
+        self.is_open = False
+        self.is_closed = True
+
+
+class _ChannelImpl:
+    """The parts of pika.channel.Channel that rabbitmq.Publisher drives directly."""
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._on_confirm = None
+        # callbacks and (tag, body) publishes for the next process_data_events
+        self._events = []
+        self._sent = []
+        self._tag = 0
+
+    def confirm_delivery(self, ack_nack_callback, callback=None):
+        self._on_confirm = ack_nack_callback
+        if callback is not None:
+            self._events.append(lambda: callback(pika.frame.Method(1, pika.spec.Confirm.SelectOk())))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        if self._connection.is_closed:
+            raise pika.exceptions.ChannelWrongStateError('channel is closed')
+        if self._on_confirm is None:
+            self._connection.broker._deliver(self._connection, [body])
+            return
+        self._tag += 1
+        self._sent.append((self._tag, body))
+
+    def _flush(self):
+        events, self._events = self._events, []
+        for event in events:
+            event()
+        if self._sent:
+            sent, self._sent = self._sent, []
+            self._connection.broker._deliver(self._connection, [body for _, body in sent])
+            self._on_confirm(pika.frame.Method(1, pika.spec.Basic.Ack(delivery_tag=sent[-1][0], multiple=True)))
+
+
+class _Channel:
+    def __init__(self, connection):
+        self._connection = connection
+        self._impl = _ChannelImpl(connection)
+
+    @property
+    def is_open(self):
+        return self._connection.is_open
+
+    @property
+    def is_closed(self):
+        return self._connection.is_closed
+
+    def exchange_declare(self, exchange, exchange_type='direct', durable=False, **kwargs):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        self._impl.basic_publish(exchange, routing_key, body, properties, mandatory)
@@ -0,0 +1,376 @@
+"""Load test payment2 against local stand-ins.
+
+Starts stand-ins for the user service, cart service and payment gateway,
+an in-memory broker and the Flask app itself, then drives /pay/<id> with
+realistic carts at an open-loop arrival rate. Results are printed, or
+written with --out, as JSON so runs can be compared across commits.
+
+    cd src/payment
+    python3 -m bench.run --rate 100 --duration 30 --out after.json
+    python3 -m bench.run --compare before.json after.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.standins import StandIn, user_route, cart_route, gateway_route
+from bench.broker import InMemoryBroker
+
+# from the catalogue seed data
+PRODUCTS = [
+    ('Watson', 'Watson', 2001),
+    ('Ewooid', 'Ewooid', 200),
+    ('HPTD', 'High-Powered Travel Droid', 1200),
+    ('UHJ', 'Ultimate Harvesting Juggernaut', 5000),
+    ('EPE', 'Extreme Probe Emulator', 953),
+    ('EMM', 'Exceptional Medical Machine', 1024),
+    ('SHCE', 'Strategic Human Control Emulator', 300),
+    ('RED', 'Responsive Enforcer Droid', 700),
+    ('RMC', 'Robotic Mining Cyborg', 42),
+    ('STAN-1', 'Stan', 67),
+    ('CNA', 'Cybernated Neutralization Android', 1000)
+]
+LOCATIONS = ['United Kingdom', 'Germany', 'France', 'United States', 'Japan']
+
+STAGES = ('user_check', 'validation', 'gateway', 'publish', 'history', 'cart_delete')
+
+
+# Same shape the cart service builds, always ending in a SHIP item.
+def make_cart(rng):
+    items = []
+    for sku, name, price in rng.sample(PRODUCTS, rng.randint(1, 4)):
+        qty = rng.randint(1, 3)
+        items.append({'qty': qty, 'sku': sku, 'name': name, 'price': price, 'subtotal': qty * price})
+    cost = round(rng.uniform(5, 50), 2)
+    items.append({'qty': 1, 'sku': 'SHIP', 'name': 'shipping to ' + rng.choice(LOCATIONS),
+                  'price': cost, 'subtotal': cost})
+    total = sum(item['subtotal'] for item in items)
+    return {'total': total, 'tax': total - total / 1.2, 'items': items}
+
+
+def make_user(rng, known):
+    if rng.random() < known:
+        return 'user{}'.format(rng.randint(0, 999))
+    return 'anonymous-{}'.format(rng.getrandbits(32))
+
+
+# Send times for an open-loop run, fixed spacing or Poisson arrivals.
+def schedule(rate, duration, arrival, rng):
+    times = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(rate) if arrival == 'poisson' else 1.0 / rate
+        if t >= duration:
+            return times
+        times.append(t)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))
+    return sorted_values[idx]
+
+
+def summarise(latencies):
+    values = sorted(latencies)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3),
+        'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3)
+    }
+
+
+# Cumulative bucket counts, count and sum per stage from the histogram.
+def stage_snapshot(histogram):
+    snap = {}
+    for metric in histogram.collect():
+        for sample in metric.samples:
+            stage = sample.labels.get('stage')
+            entry = snap.setdefault(stage, {'buckets': {}, 'count': 0, 'sum': 0.0})
+            if sample.name.endswith('_bucket'):
+                entry['buckets'][float(sample.labels['le'])] = sample.value
+            elif sample.name.endswith('_count'):
+                entry['count'] = sample.value
+            elif sample.name.endswith('_sum'):
+                entry['sum'] = sample.value
+    return snap
+
+
+# Interpolate within the bucket holding the quantile. Nothing is known
+# about values below the first bound, so a quantile there gives None.
+def bucket_quantile(buckets, q):
+    bounds = sorted(buckets)
+    total = buckets[bounds[-1]]
+    if not total:
+        return None
+    rank = q * total
+    lower, below = None, 0.0
+    for bound in bounds:
+        if buckets[bound] >= rank:
+            if lower is None:
+                return None
+            if bound == float('inf'):
+                return lower
+            inside = buckets[bound] - below
+            return lower + (bound - lower) * ((rank - below) / inside if inside else 0)
+        lower, below = bound, buckets[bound]
+    return lower
+
+
+# Per-stage breakdown from the difference of two snapshots.
+def stage_breakdown(before, after):
+    out = {}
+    for stage in STAGES:
+        a = after.get(stage)
+        if a is None:
+            continue
+        b = before.get(stage, {'buckets': {}, 'count': 0, 'sum': 0.0})
+        count = a['count'] - b['count']
+        if not count:
+            continue
+        buckets = {le: v - b['buckets'].get(le, 0) for le, v in a['buckets'].items()}
+        out[stage] = {
+            'count': int(count),
+            'mean_ms': round((a['sum'] - b['sum']) / count * 1000, 3),
+            'p50_ms': _ms(bucket_quantile(buckets, 0.50)),
+            'p95_ms': _ms(bucket_quantile(buckets, 0.95)),
+            'p99_ms': _ms(bucket_quantile(buckets, 0.99))
+        }
+    return out
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Client:
+    """Keep-alive HTTP client, one connection per load generator thread."""
+
+    def __init__(self, host, port, timeout):
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._local = threading.local()
+
+    def post(self, path, body):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+            self._local.conn = conn
+        try:
+            conn.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+            resp = conn.getresponse()
+            resp.read()
+            return resp.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self._local.conn = None
+            return 0
+
+
+def start_standins(args):
+    standins = {
+        'user': StandIn('user', user_route, args.user_latency, args.jitter, args.user_errors),
+        'cart': StandIn('cart', cart_route, args.cart_latency, args.jitter, args.cart_errors),
+        'gateway': StandIn('gateway', gateway_route, args.gateway_latency, args.jitter, args.gateway_errors)
+    }
+    for standin in standins.values():
+        standin.start()
+    return standins
+
+
+# payment2 reads its settings at import, so point it at the stand-ins first
+def load_app(args, standins):
+    os.environ.update({
+        'USER_HOST': standins['user'].host,
+        'USER_PORT': str(standins['user'].port),
+        'CART_HOST': standins['cart'].host,
+        'CART_PORT': str(standins['cart'].port),
+        'PAYMENT_GATEWAY': standins['gateway'].url,
+        'JAEGER_HOST_NAME': os.getenv('JAEGER_HOST_NAME', '127.0.0.1'),
+        'JAEGER_HOST_PORT': os.getenv('JAEGER_HOST_PORT', '6831'),
+        'OUTBOX_DIR': tempfile.mkdtemp(prefix='payment-bench-outbox-')
+    })
+    os.environ.setdefault('TELEMETRY_PROFILE', args.profile)
+    # keep request logs out of the results on stdout
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    import payment2
+    return payment2
+
+
+def serve(app):
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class Handler(WSGIRequestHandler):
+        # headers and body are separate writes, don't let Nagle hold the body
+        disable_nagle_algorithm = True
+
+    # the access log costs more than some of the stages being measured
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=Handler)
+    threading.Thread(target=server.serve_forever, name='payment', daemon=True).start()
+    return server
+
+
+def drive(client, rate, duration, arrival, concurrency, rng, known):
+    times = schedule(rate, duration, arrival, rng)
+    work = [(t, make_user(rng, known), json.dumps(make_cart(rng))) for t in times]
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def one(scheduled, start, user, body):
+        status = client.post('/pay/{}'.format(user), body)
+        # measured from the scheduled send time so a backed up
+        # generator does not hide queueing delay
+        elapsed = time.perf_counter() - (start + scheduled)
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(elapsed)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='loadgen') as executor:
+        start = time.perf_counter()
+        for scheduled, user, body in work:
+            delay = start + scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(one, scheduled, start, user, body)
+    elapsed = time.perf_counter() - start
+    return latencies, statuses, len(work), elapsed
+
+
+def run(args):
+    broker = InMemoryBroker(args.broker_latency, args.broker_errors, args.broker_ack_loss, args.broker_down).install()
+    standins = start_standins(args)
+    payment2 = load_app(args, standins)
+    server = serve(payment2.app)
+    client = Client('127.0.0.1', server.server_port, args.timeout)
+    rng = random.Random(args.seed)
+
+    if args.warmup:
+        drive(client, args.rate, args.warmup, args.arrival, args.concurrency, rng, args.known_users)
+
+    histogram = payment2.PromMetrics['STAGE_LATENCY']
+    before = stage_snapshot(histogram)
+    latencies, statuses, sent, elapsed = drive(client, args.rate, args.duration, args.arrival,
+                                               args.concurrency, rng, args.known_users)
+    after = stage_snapshot(histogram)
+
+    # let the publisher catch up before reading broker stats
+    time.sleep(0.5)
+    server.shutdown()
+    for standin in standins.values():
+        standin.stop()
+    broker.uninstall()
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': {k: v for k, v in vars(args).items() if k not in ('out', 'compare')},
+        'sent': sent,
+        'ok': statuses.get(200, 0),
+        'statuses': {str(k): v for k, v in sorted(statuses.items())},
+        'duration_s': round(elapsed, 3),
+        'throughput_rps': round(statuses.get(200, 0) / elapsed, 2) if elapsed else 0,
+        'latency': summarise(latencies),
+        'stages': stage_breakdown(before, after),
+        'standins': {name: standin.stats() for name, standin in standins.items()},
+        'broker': broker.stats()
+    }
+
+
+def _change(old, new):
+    if old is None or new is None:
+        return ''
+    if not old:
+        return ''
+    return '{:+.1f}%'.format((new - old) / old * 100)
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    rows = [('throughput_rps', old.get('throughput_rps'), new.get('throughput_rps'))]
+    for key in ('mean_ms', 'p50_ms', 'p95_ms', 'p99_ms'):
+        rows.append(('latency.' + key, old['latency'].get(key), new['latency'].get(key)))
+    for stage in STAGES:
+        for key in ('mean_ms', 'p95_ms'):
+            rows.append(('{}.{}'.format(stage, key),
+                         old['stages'].get(stage, {}).get(key), new['stages'].get(stage, {}).get(key)))
+    print('{:28} {:>12} {:>12} {:>9}'.format('', old.get('commit') or old_path, new.get('commit') or new_path, 'change'))
+    for name, a, b in rows:
+        print('{:28} {:>12} {:>12} {:>9}'.format(name, '-' if a is None else a, '-' if b is None else b, _change(a, b)))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Load test the payment service against local stand-ins.')
+    parser.add_argument('--rate', type=float, default=50, help='arrivals per second')
+    parser.add_argument('--duration', type=float, default=20, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds of unmeasured load first')
+    parser.add_argument('--arrival', choices=('fixed', 'poisson'), default='poisson',
+                        help='fixed spacing or Poisson open-loop arrivals')
+    parser.add_argument('--concurrency', type=int, default=256, help='max requests in flight')
+    parser.add_argument('--timeout', type=float, default=30, help='client timeout in seconds')
+    parser.add_argument('--known-users', type=float, default=0.7, help='share of payments by registered users')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--profile', default='lean', help='TELEMETRY_PROFILE unless already set')
+    parser.add_argument('--jitter', type=float, default=0.25, help='lognormal sigma applied to stand-in latency')
+    parser.add_argument('--user-latency', type=float, default=5, help='ms')
+    parser.add_argument('--user-errors', type=float, default=0.0, help='share of 503 answers')
+    parser.add_argument('--cart-latency', type=float, default=5, help='ms')
+    parser.add_argument('--cart-errors', type=float, default=0.0, help='share of 503 answers')
+    parser.add_argument('--gateway-latency', type=float, default=50, help='ms')
+    parser.add_argument('--gateway-errors', type=float, default=0.0, help='share of 503 answers')
+    parser.add_argument('--broker-latency', type=float, default=1, help='ms per confirm round trip')
+    parser.add_argument('--broker-errors', type=float, default=0.0, help='share of round trips that drop the connection')
+    parser.add_argument('--broker-ack-loss', type=float, default=0.0,
+                        help='share of round trips that drop the connection after storing, before the ack')
+    parser.add_argument('--broker-down', action='store_true', help='refuse every broker connection')
+    parser.add_argument('--out', help='write results JSON here instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files and exit')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,137 @@
+import re
+import time
+import socket
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StandIn:
+    """Local HTTP stand-in for a downstream service.
+
+    Every request waits latency_ms, scaled by a lognormal factor with
+    sigma jitter when jitter is set, then answers 503 with probability
+    error_rate or whatever route() returns for the method and path.
+    """
+
+    def __init__(self, name, route, latency_ms=0, jitter=0.0, error_rate=0.0, host='127.0.0.1', port=0):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._route = route
+        self._lock = threading.Lock()
+        # open keep-alive connections, closed by stop()
+        self._connections = set()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(self.host, self.port)
+
+    def _delay(self):
+        if not self.latency_ms:
+            return 0
+        if self.jitter:
+            return self.latency_ms * random.lognormvariate(0, self.jitter) / 1000
+        return self.latency_ms / 1000
+
+    def _answer(self, method, path):
+        time.sleep(self._delay())
+        with self._lock:
+            self.requests += 1
+            if random.random() < self.error_rate:
+                self.errors += 1
+                return 503
+        return self._route(method, path)
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are separate writes, don't let Nagle hold the body
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with standin._lock:
+                    standin._connections.add(self.connection)
+
+            def finish(self):
+                with standin._lock:
+                    standin._connections.discard(self.connection)
+                super().finish()
+
+            def _reply(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                status = standin._answer(self.command, self.path)
+                body = b'OK' if status < 400 else b'error'
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = do_DELETE = _reply
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    # Stop listening and drop open connections, so pooled clients see
+    # the service go away too.
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        with self._lock:
+            connections = list(self._connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {'requests': self.requests, 'errors': self.errors}
+
+
+# user ids starting with 'user' exist, anything else is anonymous
+def user_route(method, path):
+    if method == 'GET' and re.match(r'^/check/user', path):
+        return 200
+    if method == 'GET' and path.startswith('/check/'):
+        return 404
+    if method == 'POST' and path.startswith('/order/'):
+        return 200
+    return 404
+
+
+def cart_route(method, path):
+    if method == 'DELETE' and path.startswith('/cart/'):
+        return 200
+    return 404
+
+
+def gateway_route(method, path):
+    return 200
@@ -0,0 +1,142 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from prometheus_client import Counter, Gauge
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+# Prometheus
+HITS = Counter('user_cache_hits', 'User lookups answered from cache', ['tier'])
+MISSES = Counter('user_cache_misses', 'User lookups that went to the user service')
+COLLAPSED = Counter('user_cache_collapsed', 'User lookups that waited on an identical lookup in flight')
+EVICTIONS = Counter('user_cache_evictions', 'User cache entries removed', ['reason'])
+HIT_RATIO = Gauge('user_cache_hit_ratio', 'Share of user lookups answered from cache, collapsed lookups excluded', multiprocess_mode='liveall')
+
+MISS = object()
+
+
+class UserCache:
+    """Bounded LRU cache with TTL for the user existence check.
+
+    Values are True for a known user and False for a 404, which is kept for
+    the shorter NEGATIVE_TTL. A loader returning None is not cached.
+    Concurrent misses for the same key share a single load.
+
+    With USER_CACHE_SHARED=true under uWSGI, entries are also written to
+    the uWSGI cache named by USER_CACHE_NAME so every worker process
+    benefits from a lookup made by any of them.
+    """
+    SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+    TTL = float(os.getenv('USER_CACHE_TTL', 300))
+    NEGATIVE_TTL = float(os.getenv('USER_CACHE_NEGATIVE_TTL', 30))
+    SHARED = os.getenv('USER_CACHE_SHARED', 'false').lower() == 'true'
+    NAME = os.getenv('USER_CACHE_NAME', 'users')
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._lock = threading.Lock()
+        # key -> (expires, value), oldest first
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._hits = 0
+        self._misses = 0
+        self._shared = self.SHARED and uwsgi is not None
+        if self.SHARED and not self._shared:
+            self._logger.warning('shared user cache needs uWSGI, using a per-process cache')
+
+    def _local_get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISS
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                EVICTIONS.labels('expired').inc()
+                return MISS
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _local_set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.SIZE:
+                self._entries.popitem(last=False)
+                EVICTIONS.labels('size').inc()
+
+    def _shared_get(self, key):
+        value = uwsgi.cache_get(key, self.NAME)
+        if value is None:
+            return MISS
+        return value == b'1'
+
+    def _shared_set(self, key, value, ttl):
+        uwsgi.cache_update(key, b'1' if value else b'0', max(1, int(ttl)), self.NAME)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+            HIT_RATIO.set(self._hits / (self._hits + self._misses))
+
+    def _ttl(self, value):
+        return self.TTL if value else self.NEGATIVE_TTL
+
+    # Return the cached value for key, calling loader() on a miss.
+    # Errors raised by loader() are passed to every waiting caller
+    # and nothing is cached.
+    def get(self, key, loader):
+        value = self._local_get(key)
+        if value is not MISS:
+            HITS.labels('local').inc()
+            self._count(True)
+            return value
+
+        if self._shared:
+            value = self._shared_get(key)
+            if value is not MISS:
+                HITS.labels('shared').inc()
+                self._count(True)
+                self._local_set(key, value, self._ttl(value))
+                return value
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+        if not leader:
+            # counted in COLLAPSED only, so the ratio matches HITS and MISSES
+            COLLAPSED.inc()
+            return future.result()
+
+        MISSES.inc()
+        self._count(False)
+        try:
+            value = loader()
+        except Exception as err:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(err)
+            raise
+
+        if value is not None:
+            self._local_set(key, value, self._ttl(value))
+            if self._shared:
+                self._shared_set(key, value, self._ttl(value))
+        with self._lock:
+            del self._inflight[key]
+        future.set_result(value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
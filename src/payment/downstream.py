@@ -0,0 +1,93 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from prometheus_client import Counter
+
+# Prometheus
+POOL_HITS = Counter('downstream_pool_hits', 'Requests served from a pooled keep-alive connection', ['host'])
+POOL_MISSES = Counter('downstream_pool_misses', 'Requests that had to open a new connection', ['host'])
+
+
+class _CountingPoolMixin:
+    # A connection taken from the pool without a socket has never been
+    # connected (or was dropped), so the request pays for a new handshake.
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout=timeout)
+        if getattr(conn, 'sock', None) is None:
+            POOL_MISSES.labels(self.host).inc()
+        else:
+            POOL_HITS.labels(self.host).inc()
+        return conn
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool
+        }
+
+
+class Downstream:
+    # number of hosts to keep pools for and connections kept per host
+    POOL_HOSTS = int(os.getenv('DOWNSTREAM_POOL_HOSTS', 10))
+    POOL_SIZE = int(os.getenv('DOWNSTREAM_POOL_SIZE', 20))
+    # block when the pool is exhausted instead of opening throwaway connections
+    POOL_BLOCK = os.getenv('DOWNSTREAM_POOL_BLOCK', 'false').lower() == 'true'
+    CONNECT_TIMEOUT = float(os.getenv('DOWNSTREAM_CONNECT_TIMEOUT', 2.0))
+    READ_TIMEOUT = float(os.getenv('DOWNSTREAM_READ_TIMEOUT', 5.0))
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._session = None
+
+    def _build(self):
+        session = requests.Session()
+        adapter = _PooledAdapter(pool_connections=self.POOL_HOSTS,
+                                 pool_maxsize=self.POOL_SIZE,
+                                 pool_block=self.POOL_BLOCK)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self._logger.info('downstream pool {} hosts x {} connections'.format(self.POOL_HOSTS, self.POOL_SIZE))
+        return session
+
+    def _get_session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._build()
+        return self._session
+
+    # Issue a request over the shared keep-alive pools.
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', (self.CONNECT_TIMEOUT, self.READ_TIMEOUT))
+        return self._get_session().request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._logger.info('closing downstream pools')
+                self._session.close()
+                self._session = None
@@ -0,0 +1,45 @@
+import os
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class FanOut:
+    # parallel runs submitted calls on a bounded worker pool,
+    # serial runs them inline in the request thread
+    MODE = os.getenv('PAYMENT_FANOUT', 'parallel')
+    WORKERS = int(os.getenv('PAYMENT_FANOUT_WORKERS', 16))
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.WORKERS, thread_name_prefix='fanout')
+                    self._logger.info('fan-out pool {} workers'.format(self.WORKERS))
+        return self._executor
+
+    # Start fn(*args, **kwargs) and return a Future for its result.
+    # The caller's context is copied so spans started in the worker
+    # keep the request span as their parent.
+    def submit(self, fn, *args, **kwargs):
+        if self.MODE != 'parallel':
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as err:
+                future.set_exception(err)
+            return future
+
+        ctx = contextvars.copy_context()
+        return self._get_executor().submit(ctx.run, fn, *args, **kwargs)
+
+    def close(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
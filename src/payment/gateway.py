@@ -0,0 +1,231 @@
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from prometheus_client import Counter, Gauge
+
+# Prometheus
+REQUESTS = Counter('gateway_requests', 'Calls to the payment gateway')
+BREAKER_STATE = Gauge('gateway_breaker_state', 'Gateway circuit breaker state, 0 closed, 1 half-open, 2 open', multiprocess_mode='max')
+TRANSITIONS = Counter('gateway_breaker_transitions', 'Gateway circuit breaker state changes', ['from_state', 'to_state'])
+REJECTED = Counter('gateway_breaker_rejected', 'Gateway calls refused by the circuit breaker')
+HEDGES = Counter('gateway_hedges', 'Second gateway attempts sent after the first passed p95')
+HEDGE_WINS = Counter('gateway_hedge_wins', 'Hedged gateway attempts that answered first')
+
+CLOSED = 'closed'
+HALF_OPEN = 'half-open'
+OPEN = 'open'
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker over a window of recent calls.
+
+    Opens when, over at least MIN_CALLS of the last WINDOW calls, the share
+    of failures reaches FAILURE_RATE or the share of calls slower than
+    SLOW_MS reaches SLOW_RATE. After OPEN_MS it lets HALF_OPEN_CALLS probes
+    through and closes again only if all of them are fast and succeed.
+    """
+    WINDOW = int(os.getenv('GATEWAY_BREAKER_WINDOW', 50))
+    MIN_CALLS = int(os.getenv('GATEWAY_BREAKER_MIN_CALLS', 10))
+    FAILURE_RATE = float(os.getenv('GATEWAY_BREAKER_FAILURE_RATE', 0.5))
+    SLOW_MS = int(os.getenv('GATEWAY_BREAKER_SLOW_MS', 2000))
+    SLOW_RATE = float(os.getenv('GATEWAY_BREAKER_SLOW_RATE', 0.5))
+    OPEN_MS = int(os.getenv('GATEWAY_BREAKER_OPEN_MS', 10000))
+    HALF_OPEN_CALLS = int(os.getenv('GATEWAY_BREAKER_HALF_OPEN_CALLS', 3))
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._lock = threading.Lock()
+        # (failed, slow) for recent calls
+        self._outcomes = deque(maxlen=self.WINDOW)
+        self._state = CLOSED
+        self._opened_at = 0
+        self._probes = 0
+        self._probe_successes = 0
+        BREAKER_STATE.set(STATES[CLOSED])
+
+    @property
+    def state(self):
+        return self._state
+
+    def _transition(self, state):
+        self._logger.warning('gateway circuit {} -> {}'.format(self._state, state))
+        TRANSITIONS.labels(self._state, state).inc()
+        BREAKER_STATE.set(STATES[state])
+        self._state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        elif state == HALF_OPEN:
+            self._probes = 0
+            self._probe_successes = 0
+        else:
+            self._outcomes.clear()
+
+    # True if a call may go ahead, every allowed call must be recorded.
+    def allow(self):
+        with self._lock:
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.OPEN_MS / 1000:
+                    REJECTED.inc()
+                    return False
+                self._transition(HALF_OPEN)
+            if self._state == HALF_OPEN:
+                if self._probes >= self.HALF_OPEN_CALLS:
+                    REJECTED.inc()
+                    return False
+                self._probes += 1
+            return True
+
+    def record(self, ok, elapsed):
+        slow = elapsed * 1000 >= self.SLOW_MS
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if not ok or slow:
+                    self._transition(OPEN)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.HALF_OPEN_CALLS:
+                        self._transition(CLOSED)
+                return
+            if self._state == OPEN:
+                return
+
+            self._outcomes.append((not ok, slow))
+            calls = len(self._outcomes)
+            if calls < self.MIN_CALLS:
+                return
+            failures = sum(1 for failed, _ in self._outcomes if failed)
+            slows = sum(1 for _, s in self._outcomes if s)
+            if failures / calls >= self.FAILURE_RATE or slows / calls >= self.SLOW_RATE:
+                self._transition(OPEN)
+
+
+class GatewayClient:
+    """Payment gateway calls with a deadline, circuit breaker and hedging.
+
+    Attempts run on a small pool so DEADLINE_MS bounds the whole call, a
+    gateway that trickles its answer cannot hold the request past it.
+    With GATEWAY_HEDGE=true, once HEDGE_MIN_SAMPLES latencies have been
+    seen, an attempt still running at the observed p95 gets a second
+    attempt alongside it and the first good answer wins.
+    """
+    DEADLINE_MS = int(os.getenv('GATEWAY_DEADLINE_MS', 5000))
+    HEDGE = os.getenv('GATEWAY_HEDGE', 'false').lower() == 'true'
+    HEDGE_MIN_SAMPLES = int(os.getenv('GATEWAY_HEDGE_MIN_SAMPLES', 20))
+    WORKERS = int(os.getenv('GATEWAY_WORKERS', 32))
+    SAMPLES = 200
+
+    def __init__(self, logger, http, url):
+        self._logger = logger
+        self._http = http
+        self._url = url
+        self._breaker = CircuitBreaker(logger)
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=self.SAMPLES)
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.WORKERS, thread_name_prefix='gateway')
+        return self._executor
+
+    def _p95(self):
+        with self._lock:
+            if len(self._latencies) < self.HEDGE_MIN_SAMPLES:
+                return None
+            samples = sorted(self._latencies)
+        return samples[int(len(samples) * 0.95) - 1]
+
+    def _attempt(self, timeout):
+        start = time.time()
+        connect = min(self._http.CONNECT_TIMEOUT, timeout)
+        req = self._http.get(self._url, timeout=(connect, timeout))
+        if req.status_code < 500:
+            with self._lock:
+                self._latencies.append(time.time() - start)
+        return req
+
+    def _submit(self, timeout):
+        ctx = contextvars.copy_context()
+        return self._get_executor().submit(ctx.run, self._attempt, timeout)
+
+    def _single(self, deadline):
+        future = self._submit(deadline)
+        done, _ = wait([future], timeout=deadline)
+        if not done:
+            future.cancel()
+            raise requests.exceptions.Timeout('payment gateway deadline exceeded')
+        return future.result()
+
+    def _hedged(self, deadline):
+        p95 = self._p95()
+        if p95 is None or p95 >= deadline:
+            return self._single(deadline)
+
+        start = time.time()
+        first = self._submit(deadline)
+        done, _ = wait([first], timeout=p95)
+        if done:
+            return first.result()
+
+        HEDGES.inc()
+        second = self._submit(deadline - (time.time() - start))
+        pending = {first, second}
+        fallback = None
+        error = None
+        while pending:
+            remaining = deadline - (time.time() - start)
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                elif future.result().status_code >= 500:
+                    # a 5xx loses to the other attempt, but stands if both fail
+                    fallback = future.result()
+                else:
+                    if future is second:
+                        HEDGE_WINS.inc()
+                    return future.result()
+        if pending:
+            raise requests.exceptions.Timeout('payment gateway deadline exceeded')
+        if fallback is not None:
+            return fallback
+        raise error
+
+    def get(self):
+        if not self._breaker.allow():
+            raise CircuitOpenError('payment gateway circuit open')
+        REQUESTS.inc()
+        deadline = self.DEADLINE_MS / 1000
+        start = time.time()
+        ok = False
+        # record every allowed call, whatever it raises, or a half-open
+        # probe slot is never given back
+        try:
+            if self.HEDGE:
+                req = self._hedged(deadline)
+            else:
+                req = self._single(deadline)
+            ok = req.status_code < 500
+            return req
+        finally:
+            self._breaker.record(ok, time.time() - start)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
@@ -0,0 +1,395 @@
+import os
+import json
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import itertools
+import threading
+from collections import OrderedDict
+from prometheus_client import Counter, Gauge
+
+# Prometheus
+DEPTH = Gauge('outbox_depth', 'Orders spooled to disk waiting for replay', multiprocess_mode='livesum')
+SEGMENTS = Gauge('outbox_segments', 'Outbox segment files on disk', multiprocess_mode='livesum')
+SPOOLED = Counter('outbox_spooled', 'Orders written to the outbox')
+
+# payload length, crc32 of payload
+HEADER = struct.Struct('<II')
+
+
+class Outbox:
+    """Append-only on-disk queue of orders waiting for the broker.
+
+    Records are appended to memory-mapped, preallocated segment files and
+    read back in order. The read position is kept in a checkpoint file,
+    written on every commit, and segments are deleted once fully read.
+    Dirty pages are synced in the background every FSYNC_MS, so a process
+    crash loses nothing and a host crash loses at most that window. Disk
+    work on commit and sync happens outside the lock append() takes.
+
+    The last DEDUP_SIZE orderids marked delivered are kept in a log next
+    to the checkpoint, so the replayer can skip orders it already got a
+    confirm for, across retries and restarts.
+
+    Each process claims its own slot directory with a lock file, so
+    pre-forked workers never share segments and a restarted worker
+    recovers whatever an earlier one left behind. Slots that no process
+    holds any more can be taken over with orphans().
+    """
+    DIR = os.getenv('OUTBOX_DIR', '/tmp/payment-outbox')
+    SEGMENT_BYTES = int(os.getenv('OUTBOX_SEGMENT_BYTES', 4 * 1024 * 1024))
+    FSYNC_MS = int(os.getenv('OUTBOX_FSYNC_MS', 50))
+    DEDUP_SIZE = int(os.getenv('OUTBOX_DEDUP_SIZE', 100000))
+    CHECKPOINT = 'checkpoint'
+    DELIVERED = 'delivered'
+
+    def __init__(self, logger, directory=None, slot=None):
+        self._logger = logger
+        self._cond = threading.Condition()
+        # checkpoint, delivered log and segment file I/O
+        self._io_lock = threading.Lock()
+        self._checkpointed = None
+        self._delivered = OrderedDict()
+        self._delivered_file = None
+        self._delivered_lines = 0
+        self._delivered_dirty = False
+        # seq -> (file, mmap)
+        self._segments = {}
+        self._write_seq = None
+        self._write_off = 0
+        self._next_seq = 0
+        self._read_seq = 0
+        self._read_off = 0
+        self._depth = 0
+        self._dirty = False
+        self._closed = False
+        self._lock_file = None
+        self._root = directory or self.DIR
+        self._dir = self._claim_slot(self._root, slot)
+        self._recover()
+        self._flusher = threading.Thread(target=self._flush_loop, name='outbox-fsync', daemon=True)
+        self._flusher.start()
+
+    # Lock the lowest free slot, or just the given one, raising
+    # BlockingIOError if another process holds it.
+    def _claim_slot(self, root, slot=None):
+        os.makedirs(root, exist_ok=True)
+        for n in itertools.count() if slot is None else [slot]:
+            path = os.path.join(root, str(n))
+            os.makedirs(path, exist_ok=True)
+            lock_file = open(os.path.join(path, 'lock'), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                if slot is not None:
+                    raise
+                continue
+            self._lock_file = lock_file
+            self._logger.info('outbox using {}'.format(path))
+            return path
+
+    def _path(self, seq):
+        return os.path.join(self._dir, '{:020d}.seg'.format(seq))
+
+    def _fsync_dir(self):
+        fd = os.open(self._dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _open(self, seq, size=None):
+        if size is not None:
+            f = open(self._path(seq), 'w+b')
+            f.truncate(size)
+            self._fsync_dir()
+        else:
+            f = open(self._path(seq), 'r+b')
+        mm = mmap.mmap(f.fileno(), 0)
+        self._segments[seq] = (f, mm)
+        SEGMENTS.inc()
+        return mm
+
+    # Take seq out of the live segments, the files go in _drop().
+    def _detach(self, seq):
+        f, mm = self._segments.pop(seq)
+        SEGMENTS.dec()
+        return seq, f, mm
+
+    def _drop(self, segment):
+        seq, f, mm = segment
+        mm.close()
+        f.close()
+        os.unlink(self._path(seq))
+
+    def _remove(self, seq):
+        self._drop(self._detach(seq))
+
+    # Yield (start, end, payload) for each intact record from offset.
+    # A zero length header marks the end of the written data.
+    def _records(self, mm, offset):
+        while offset + HEADER.size <= len(mm):
+            length, crc = HEADER.unpack_from(mm, offset)
+            end = offset + HEADER.size + length
+            if length == 0 or end > len(mm):
+                return
+            payload = mm[offset + HEADER.size:end]
+            if zlib.crc32(payload) != crc:
+                return
+            yield offset, end, payload
+            offset = end
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self._dir, self.CHECKPOINT)) as f:
+                seq, off = f.read().split()
+                return int(seq), int(off)
+        except (OSError, ValueError):
+            return 0, 0
+
+    # Persist position, unless a later one already is. Called with
+    # _io_lock held, or during recovery.
+    def _write_checkpoint(self, position):
+        if self._checkpointed is not None and position <= self._checkpointed:
+            return
+        path = os.path.join(self._dir, self.CHECKPOINT)
+        with open(path + '.tmp', 'w') as f:
+            f.write('{} {}\n'.format(*position))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self._checkpointed = position
+
+    def _load_delivered(self):
+        path = os.path.join(self._dir, self.DELIVERED)
+        try:
+            with open(path) as f:
+                for line in f:
+                    self._remember(line.strip())
+                    self._delivered_lines += 1
+        except OSError:
+            pass
+        self._delivered_file = open(path, 'a')
+        if self._delivered_lines > self.DEDUP_SIZE:
+            self._compact_delivered()
+
+    def _remember(self, orderid):
+        if not orderid:
+            return False
+        if orderid in self._delivered:
+            return False
+        self._delivered[orderid] = True
+        if len(self._delivered) > self.DEDUP_SIZE:
+            self._delivered.popitem(last=False)
+        return True
+
+    # Rewrite the log with only the orderids still remembered.
+    def _compact_delivered(self):
+        path = os.path.join(self._dir, self.DELIVERED)
+        with open(path + '.tmp', 'w') as f:
+            f.write(''.join(orderid + '\n' for orderid in self._delivered))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self._delivered_file.close()
+        self._delivered_file = open(path, 'a')
+        self._delivered_lines = len(self._delivered)
+        self._delivered_dirty = False
+
+    def _sync_delivered(self):
+        if self._delivered_dirty:
+            os.fsync(self._delivered_file.fileno())
+            self._delivered_dirty = False
+
+    def _recover(self):
+        self._load_delivered()
+        seqs = sorted(int(n[:-4]) for n in os.listdir(self._dir) if n.endswith('.seg'))
+        self._read_seq, self._read_off = self._load_checkpoint()
+        self._next_seq = max(seqs[-1] + 1 if seqs else 0, self._read_seq)
+
+        for seq in seqs:
+            mm = self._open(seq)
+            if seq < self._read_seq:
+                # fully read before the last shutdown
+                self._remove(seq)
+                continue
+            if seq > self._read_seq and not self._depth:
+                # checkpoint pointed at a segment that is gone
+                self._read_seq, self._read_off = seq, 0
+
+            off = self._read_off if seq == self._read_seq else 0
+            for start, end, payload in self._records(mm, off):
+                self._depth += 1
+                off = end
+            if seq == seqs[-1]:
+                # clear anything torn after the last intact record
+                if off + HEADER.size <= len(mm) and HEADER.unpack_from(mm, off) != (0, 0):
+                    self._logger.warning('outbox truncating torn record in segment {}'.format(seq))
+                    mm[off:] = bytes(len(mm) - off)
+                    mm.flush()
+                self._write_seq = seq
+                self._write_off = off
+            elif off + HEADER.size <= len(mm) and HEADER.unpack_from(mm, off) != (0, 0):
+                self._logger.warning('outbox segment {} is damaged after offset {}'.format(seq, off))
+
+        if self._depth:
+            self._logger.info('outbox recovered {} orders'.format(self._depth))
+        else:
+            # nothing left to replay, start clean
+            for seq in list(self._segments):
+                self._remove(seq)
+            self._write_seq = None
+            self._read_seq, self._read_off = self._next_seq, 0
+        self._write_checkpoint((self._read_seq, self._read_off))
+        DEPTH.inc(self._depth)
+
+    def _roll(self, size):
+        if self._write_seq is not None:
+            self._segments[self._write_seq][1].flush()
+            self._next_seq = self._write_seq + 1
+        self._write_seq = self._next_seq
+        self._write_off = 0
+        self._open(self._write_seq, max(self.SEGMENT_BYTES, size + HEADER.size))
+
+    # redelivered marks an order that may already have reached the broker.
+    def append(self, msg, headers, redelivered=False):
+        rec = {'msg': msg, 'headers': headers}
+        if redelivered:
+            rec['redelivered'] = True
+        payload = json.dumps(rec).encode()
+        size = HEADER.size + len(payload)
+        with self._cond:
+            if self._write_seq is None or self._write_off + size > len(self._segments[self._write_seq][1]):
+                self._roll(size)
+            mm = self._segments[self._write_seq][1]
+            # payload before header, a torn write leaves a zero header behind
+            start = self._write_off + HEADER.size
+            mm[start:start + len(payload)] = payload
+            HEADER.pack_into(mm, self._write_off, len(payload), zlib.crc32(payload))
+            self._write_off += size
+            self._depth += 1
+            self._dirty = True
+            DEPTH.inc()
+            self._cond.notify_all()
+        SPOOLED.inc()
+
+    def pending(self):
+        return self._depth > 0
+
+    def delivered(self, orderid):
+        with self._io_lock:
+            return orderid in self._delivered
+
+    # Remember orderids the broker confirmed, written through to the log
+    # and made durable by the next commit or sync.
+    def mark_delivered(self, orderids):
+        with self._io_lock:
+            lines = [orderid + '\n' for orderid in orderids if self._remember(orderid)]
+            if not lines:
+                return
+            self._delivered_file.write(''.join(lines))
+            self._delivered_file.flush()
+            self._delivered_lines += len(lines)
+            self._delivered_dirty = True
+            if self._delivered_lines > 2 * self.DEDUP_SIZE:
+                self._compact_delivered()
+
+    # Claim every other slot under the same directory that still has
+    # segments but no owner, e.g. after a restart with fewer workers.
+    def orphans(self):
+        found = []
+        for name in sorted(os.listdir(self._root)):
+            path = os.path.join(self._root, name)
+            if not name.isdigit() or path == self._dir:
+                continue
+            if not any(n.endswith('.seg') for n in os.listdir(path)):
+                continue
+            try:
+                found.append(type(self)(self._logger, self._root, int(name)))
+            except BlockingIOError:
+                continue
+        return found
+
+    # Return up to limit (position, msg, headers, redelivered) records from
+    # the read position without consuming them, see commit().
+    def read(self, limit):
+        out = []
+        with self._cond:
+            seq, off = self._read_seq, self._read_off
+            while len(out) < limit and seq in self._segments:
+                for start, end, payload in self._records(self._segments[seq][1], off):
+                    rec = json.loads(payload)
+                    out.append(((seq, end), rec['msg'], rec['headers'], rec.get('redelivered', False)))
+                    off = end
+                    if len(out) >= limit:
+                        break
+                if len(out) >= limit or seq == self._write_seq:
+                    break
+                seq, off = seq + 1, 0
+        return out
+
+    # Mark the count records up to position as consumed, durably.
+    def commit(self, position, count=1):
+        with self._cond:
+            self._read_seq, self._read_off = position
+            self._depth -= count
+            done = [seq for seq in self._segments if seq < self._read_seq]
+            if self._depth == 0 and self._write_seq is not None:
+                # fully drained, drop the live segment too
+                done.append(self._write_seq)
+                self._next_seq = self._write_seq + 1
+                self._write_seq = None
+                self._read_seq, self._read_off = self._next_seq, 0
+            checkpoint = (self._read_seq, self._read_off)
+            detached = [self._detach(seq) for seq in done]
+            DEPTH.dec(count)
+        with self._io_lock:
+            self._sync_delivered()
+            # persist the position before the data behind it goes
+            self._write_checkpoint(checkpoint)
+            for segment in detached:
+                self._drop(segment)
+
+    # Block until there is something to read or timeout expires.
+    def wait(self, timeout):
+        with self._cond:
+            if self._depth == 0:
+                self._cond.wait(timeout)
+            return self._depth > 0
+
+    def sync(self):
+        with self._cond:
+            dirty, self._dirty = self._dirty, False
+            mm = self._segments[self._write_seq][1] if dirty and self._write_seq is not None else None
+            checkpoint = (self._read_seq, self._read_off)
+        with self._io_lock:
+            # commit() may have dropped the segment meanwhile
+            if mm is not None and not mm.closed:
+                mm.flush()
+            if dirty:
+                self._write_checkpoint(checkpoint)
+            self._sync_delivered()
+
+    def _flush_loop(self):
+        while not self._closed:
+            time.sleep(self.FSYNC_MS / 1000)
+            self.sync()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.sync()
+        with self._cond, self._io_lock:
+            for f, mm in self._segments.values():
+                mm.close()
+                f.close()
+            SEGMENTS.dec(len(self._segments))
+            DEPTH.dec(self._depth)
+            self._segments.clear()
+            self._delivered_file.close()
+        if self._lock_file is not None:
+            self._lock_file.close()
@@ -3,9 +3,6 @@ import random
 
 from opentelemetry import trace
 from opentelemetry.exporter.jaeger.thrift import JaegerExporter
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import ConsoleSpanExporter, BatchSpanProcessor
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
 
@@ -18,43 +15,46 @@ import uuid
 import json
 import requests
 import traceback
+import atexit
+import threading
+from contextlib import contextmanager
 from flask import Flask
 from flask import Response
 from flask import request
 from flask import jsonify
-from rabbitmq import Publisher
+from rabbitmq import BatchPublisher, OutboxReplayer
+from outbox import Outbox
+from downstream import Downstream
+from fanout import FanOut
+from cache import UserCache
+from gateway import GatewayClient
+import telemetry
 # Prometheus
 import prometheus_client
-from prometheus_client import Counter, Histogram
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client import multiprocess
+# uWSGI
+try:
+    import uwsgi
+    from uwsgidecorators import postfork
+except ImportError:
+    uwsgi = None
 JAEGER_HOST_NAME = os.environ.get('JAEGER_HOST_NAME')
 JAEGER_HOST_PORT = os.environ.get('JAEGER_HOST_PORT')
-# SpanExporter receives the spans and send them to the target location.
-trace.set_tracer_provider(
-    TracerProvider(
-        resource=Resource.create({SERVICE_NAME: "payment"})
-    )
-)
-
-jaeger_exporter = JaegerExporter(
-    agent_host_name=JAEGER_HOST_NAME,
-    agent_port= int(JAEGER_HOST_PORT),
-)
-
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(jaeger_exporter)
-)
-trace.get_tracer_provider().add_span_processor(BatchSpanProcessor(ConsoleSpanExporter()))
+# sampling, console export and log handling, see telemetry.Profile
+profile = telemetry.Profile()
 
 app = Flask(__name__)
 FlaskInstrumentor().instrument_app(app)
 RequestsInstrumentor().instrument()
-app.logger.setLevel(logging.INFO)
 
 
 tracer = trace.get_tracer(__name__)
 
 CART = os.getenv('CART_HOST', 'cart')
 USER = os.getenv('USER_HOST', 'user')
+CART_PORT = os.getenv('CART_PORT', '8080')
+USER_PORT = os.getenv('USER_PORT', '8080')
 PAYMENT_GATEWAY = os.getenv('PAYMENT_GATEWAY', 'https://paypal.com/')
 
 # Prometheus
@@ -62,6 +62,19 @@ PromMetrics = {}
 PromMetrics['SOLD_COUNTER'] = Counter('sold_count', 'Running count of items sold')
 PromMetrics['AUS'] = Histogram('units_sold', 'Avergae Unit Sale', buckets=(1, 2, 5, 10, 100))
 PromMetrics['AVS'] = Histogram('cart_value', 'Avergae Value Sale', buckets=(100, 200, 500, 1000, 2000, 5000, 10000))
+PromMetrics['STAGE_LATENCY'] = Histogram('pay_stage_seconds', 'Time spent in each stage of /pay', ['stage'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+PromMetrics['IN_FLIGHT'] = Gauge('pay_in_flight', 'Payments being processed', multiprocess_mode='livesum')
+PromMetrics['STAGE_IN_FLIGHT'] = Gauge('pay_stage_in_flight', 'Calls in progress in each stage of /pay', ['stage'],
+    multiprocess_mode='livesum')
+
+# With PROMETHEUS_MULTIPROC_DIR set every pre-forked worker writes its
+# samples there and /metrics aggregates them all.
+if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+else:
+    registry = prometheus_client.REGISTRY
 
 
 @app.errorhandler(Exception)
@@ -69,54 +82,76 @@ def exception_handler(err):
     app.logger.error(str(err))
     return str(err), 500
 
+# set once this worker has its connections and background threads
+ready = threading.Event()
+
 @app.route('/health', methods=['GET'])
 def health():
+    if not ready.is_set():
+        return 'not ready', 503
     return 'OK'
 
 # Prometheus
 @app.route('/metrics', methods=['GET'])
 def metrics():
-    res = []
-    for m in PromMetrics.values():
-        res.append(prometheus_client.generate_latest(m))
+    return Response(prometheus_client.generate_latest(registry), mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+@contextmanager
+def stage(name):
+    with PromMetrics['STAGE_IN_FLIGHT'].labels(name).track_inprogress(), \
+            PromMetrics['STAGE_LATENCY'].labels(name).time():
+        yield
 
-    return Response(res, mimetype='text/plain')
+
+def timed(name, fn, *args, **kwargs):
+    with stage(name):
+        return fn(*args, **kwargs)
 
 
 @app.route('/pay/<id>', methods=['POST'])
+@PromMetrics['IN_FLIGHT'].track_inprogress()
 def pay(id):
     with tracer.start_as_current_span("pay"):
-        app.logger.info('payment for {}'.format(id))
-        app.logger.info('payment for {}'.format(id))
+        app.logger.info('payment for %s', id)
         cart = request.get_json()
-        app.logger.info(cart)
+        app.logger.debug('cart %s', cart)
 
         anonymous_user = True
 
         # check user exists
+        # runs alongside cart validation and the gateway call
+        user_check = fanout.submit(timed, 'user_check', userExists, id)
+
+    # check that the cart is valid
+    # this will blow up if the cart is not valid
+        with stage('validation'):
+            has_shipping = False
+            for item in cart.get('items'):
+                if item.get('sku') == 'SHIP':
+                    has_shipping = True
+
+            cart_valid = cart.get('total', 0) != 0 and has_shipping
+
+        # dummy call to payment gateway, hope they dont object
+        gateway_call = None
+        if cart_valid:
+            gateway_call = fanout.submit(timed, 'gateway', payment_gateway.get)
+
         try:
-            req = requests.get('http://{user}:8080/check/{id}'.format(user=USER, id=id))
+            if user_check.result():
+                anonymous_user = False
         except requests.exceptions.RequestException as err:
             app.logger.error(err)
             return str(err), 500
-        if req.status_code == 200:
-            anonymous_user = False
-
-    # check that the cart is valid
-    # this will blow up if the cart is not valid
-        has_shipping = False
-        for item in cart.get('items'):
-            if item.get('sku') == 'SHIP':
-                has_shipping = True
 
-        if cart.get('total', 0) == 0 or has_shipping == False:
-            app.logger.warn('cart not valid')
+        if not cart_valid:
+            app.logger.warning('cart not valid')
             return 'cart not valid', 400
 
-        # dummy call to payment gateway, hope they dont object
         try:
-            req = requests.get(PAYMENT_GATEWAY)
-            app.logger.info('{} returned {}'.format(PAYMENT_GATEWAY, req.status_code))
+            req = gateway_call.result()
+            app.logger.info('%s returned %s', PAYMENT_GATEWAY, req.status_code)
         except requests.exceptions.RequestException as err:
             app.logger.error(err)
             return str(err), 500
@@ -132,23 +167,28 @@ def pay(id):
 
         # Generate order id
         orderid = str(uuid.uuid4())
-        queueOrder({ 'orderid': orderid, 'user': id, 'cart': cart })
+        with stage('publish'):
+            queueOrder({ 'orderid': orderid, 'user': id, 'cart': cart })
 
-        # add to order history
+        # add to order history and delete cart, independent of each other
+        history = None
         if not anonymous_user:
+            history = fanout.submit(timed, 'history', http.post, 'http://{user}:{port}/order/{id}'.format(user=USER, port=USER_PORT, id=id),
+                data=json.dumps({'orderid': orderid, 'cart': cart}),
+                headers={'Content-Type': 'application/json'})
+        cart_delete = fanout.submit(timed, 'cart_delete', http.delete, 'http://{cart}:{port}/cart/{id}'.format(cart=CART, port=CART_PORT, id=id))
+
+        if history is not None:
             try:
-                req = requests.post('http://{user}:8080/order/{id}'.format(user=USER, id=id),
-                    data=json.dumps({'orderid': orderid, 'cart': cart}),
-                    headers={'Content-Type': 'application/json'})
-                app.logger.info('order history returned {}'.format(req.status_code))
+                req = history.result()
+                app.logger.info('order history returned %s', req.status_code)
             except requests.exceptions.RequestException as err:
                 app.logger.error(err)
                 return str(err), 500
 
-        # delete cart
         try:
-            req = requests.delete('http://{cart}:8080/cart/{id}'.format(cart=CART, id=id))
-            app.logger.info('cart delete returned {}'.format(req.status_code))
+            req = cart_delete.result()
+            app.logger.info('cart delete returned %s', req.status_code)
         except requests.exceptions.RequestException as err:
             app.logger.error(err)
             return str(err), 500
@@ -158,6 +198,21 @@ def pay(id):
     return jsonify({ 'orderid': orderid })
 
 
+def userExists(id):
+    return user_cache.get(id, lambda: checkUser(id))
+
+
+# True for a known user, False if the user service says not found,
+# None for any other answer so it is not cached
+def checkUser(id):
+    req = http.get('http://{user}:{port}/check/{id}'.format(user=USER, port=USER_PORT, id=id))
+    if req.status_code == 200:
+        return True
+    if req.status_code == 404:
+        return False
+    return None
+
+
 def queueOrder(order):
     app.logger.info('queue order')
 
@@ -178,14 +233,93 @@ def countItems(items):
     return count
 
 
-# RabbitMQ
-publisher = Publisher(app.logger)
+# Per-worker state. Threads, sockets and the span pipeline do not survive
+# fork, so under a pre-forking server every worker builds its own.
+tracer_provider = None
+log_listener = None
+spool = None
+replayer = None
+publisher = None
+http = None
+fanout = None
+user_cache = None
+payment_gateway = None
+
+
+def init_worker():
+    global tracer_provider, log_listener, spool, replayer, publisher, http, fanout, user_cache, payment_gateway
+    log_listener = telemetry.configure_logging(profile, app.logger)
+
+    # SpanExporter receives the spans and send them to the target location.
+    jaeger_exporter = JaegerExporter(
+        agent_host_name=JAEGER_HOST_NAME,
+        agent_port= int(JAEGER_HOST_PORT),
+    )
+    tracer_provider = telemetry.tracer_provider(profile, "payment", [jaeger_exporter])
+    trace.set_tracer_provider(tracer_provider)
+
+    # RabbitMQ
+    # orders are published in confirmed batches from a background thread,
+    # spilling to the on-disk outbox while the broker is down or slow
+    if os.getenv('OUTBOX_ENABLED', 'true').lower() == 'true':
+        spool = Outbox(app.logger)
+        replayer = OutboxReplayer(app.logger, spool)
+        replayer.start()
+    publisher = BatchPublisher(app.logger, spool)
+    # shared keep-alive pools for user, cart and gateway
+    http = Downstream(app.logger)
+    # runs independent steps of /pay concurrently
+    fanout = FanOut(app.logger)
+    # remembers which user ids exist
+    user_cache = UserCache(app.logger)
+    # deadline, circuit breaker and optional hedging for the gateway
+    payment_gateway = GatewayClient(app.logger, http, PAYMENT_GATEWAY)
+
+    ready.set()
+    app.logger.info('worker %s ready', os.getpid())
+
+
+# Drain the worker on shutdown, queued orders are published or spooled
+# to the outbox and pending spans are exported.
+def shutdown_worker():
+    if not ready.is_set():
+        return
+    ready.clear()
+    app.logger.info('worker %s draining', os.getpid())
+    drained = publisher.close()
+    if replayer is not None:
+        # the publisher may still spill into the outbox they share
+        replayer.close(keep_outbox=not drained)
+    fanout.close()
+    payment_gateway.close()
+    http.close()
+    tracer_provider.shutdown()
+    if registry is not prometheus_client.REGISTRY:
+        multiprocess.mark_process_dead(os.getpid())
+    if log_listener is not None:
+        log_listener.stop()
+
+
+def uwsgiFlag(name):
+    value = uwsgi.opt.get(name, False)
+    if isinstance(value, bytes):
+        value = value.decode()
+    return value is True or str(value).lower() in ('true', '1', 'yes', 'on')
+
+
+# With the app preloaded in the uWSGI master each worker initialises
+# after the fork, otherwise this process is the worker.
+if uwsgi is not None and not (uwsgiFlag('lazy-apps') or uwsgiFlag('lazy')):
+    postfork(init_worker)
+else:
+    init_worker()
+if uwsgi is not None:
+    uwsgi.atexit = shutdown_worker
+else:
+    atexit.register(shutdown_worker)
 
 if __name__ == "__main__":
-    sh = logging.StreamHandler(sys.stdout)
-    sh.setLevel(logging.INFO)
-    fmt = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    app.logger.info('Payment gateway {}'.format(PAYMENT_GATEWAY))
+    app.logger.info('Payment gateway %s', PAYMENT_GATEWAY)
     port = int(os.getenv("SHOP_PAYMENT_PORT", "8080"))
-    app.logger.info('Starting on port {}'.format(port))
+    app.logger.info('Starting on port %s', port)
     app.run(host='0.0.0.0', port=port)
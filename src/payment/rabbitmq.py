@@ -1,6 +1,26 @@
 import json
 import pika
 import os
+import time
+import queue
+import threading
+from collections import deque
+from prometheus_client import Counter, Gauge, Histogram
+
+# Prometheus
+QUEUE_DEPTH = Gauge('amqp_queue_depth', 'Orders waiting in the publish queue', multiprocess_mode='livesum')
+BATCH_LATENCY = Histogram('amqp_batch_seconds', 'Time to publish and confirm a batch',
+                          buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+BATCH_SIZE = Histogram('amqp_batch_size', 'Orders per published batch', buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+DROPPED = Counter('amqp_dropped', 'Orders rejected because the publish queue was full')
+REPLAYED = Counter('outbox_replayed', 'Spooled orders published from the outbox')
+REDELIVERED = Counter('outbox_redelivered', 'Spooled orders replayed that may already have reached the broker')
+DEDUPED = Counter('outbox_deduped', 'Spooled orders skipped as already confirmed by the broker')
+
+
+class PublishQueueFull(Exception):
+    pass
+
 
 class Publisher:
     HOST = os.getenv('AMQP_HOST', 'rabbitmq')
@@ -8,6 +28,9 @@ class Publisher:
     EXCHANGE='robot-shop'
     TYPE='direct'
     ROUTING_KEY = 'orders'
+    # publisher confirms, see _publish_confirmed
+    CONFIRM = False
+    CONFIRM_MS = int(os.getenv('AMQP_CONFIRM_MS', 5000))
 
     def __init__(self, logger):
         self._logger = logger
@@ -17,20 +40,122 @@ class Publisher:
             credentials=pika.credentials.PlainCredentials('guest', 'guest'))
         self._conn = None
         self._channel = None
+        # delivery tags awaiting a confirm and those the broker nacked
+        self._tag = 0
+        self._unconfirmed = set()
+        self._nacked = set()
 
     def _connect(self):
         if not self._conn or self._conn.is_closed or self._channel is None or self._channel.is_closed:
             self._conn = pika.BlockingConnection(self._params)
             self._channel = self._conn.channel()
             self._channel.exchange_declare(exchange=self.EXCHANGE, exchange_type=self.TYPE, durable=True)
+            if self.CONFIRM:
+                self._confirm_select()
             self._logger.info('connected to broker')
 
+    # Confirm mode is set on the channel underneath the BlockingChannel,
+    # which would otherwise wait for each confirm before the next publish.
+    def _confirm_select(self):
+        self._tag = 0
+        self._unconfirmed = set()
+        self._nacked = set()
+        selected = []
+
+        def on_select(frame):
+            selected.append(frame)
+            self._wake()
+
+        self._channel._impl.confirm_delivery(self._on_confirm, on_select)
+        self._wait(lambda: selected)
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            self._unconfirmed.discard(tag)
+            if isinstance(method, pika.spec.Basic.Nack):
+                self._nacked.add(tag)
+        if not self._unconfirmed:
+            self._wake()
+
+    # process_data_events only returns early for BlockingConnection events,
+    # not for callbacks on the channel underneath, so give it one.
+    def _wake(self):
+        self._conn.call_later(0, lambda: None)
+
+    def _wait(self, done):
+        deadline = time.monotonic() + self.CONFIRM_MS / 1000
+        while not done():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise pika.exceptions.AMQPChannelError('timed out waiting for the broker')
+            if self._channel.is_closed:
+                raise pika.exceptions.ChannelWrongStateError('channel closed')
+            self._conn.process_data_events(remaining)
+
+    # Publish (msg, headers) items without waiting in between, then wait
+    # once for all their confirms. Returns the confirmed items, the rest
+    # as (item, sent) pairs, where sent means it may have reached the
+    # broker without its confirm coming back, and the error if any.
+    def _publish_confirmed(self, items):
+        if not items:
+            return [], [], None
+        tags = []
+        error = None
+        try:
+            self._connect()
+            self._nacked.clear()
+            for msg, headers in items:
+                self._channel._impl.basic_publish(self.EXCHANGE, self.ROUTING_KEY, json.dumps(msg).encode(),
+                                                  pika.BasicProperties(headers=headers, message_id=msg.get('orderid')))
+                self._tag += 1
+                self._unconfirmed.add(self._tag)
+                tags.append(self._tag)
+            self._wait(lambda: not self._unconfirmed)
+        except (pika.exceptions.AMQPError, OSError) as err:
+            error = err
+
+        confirmed, failed = [], []
+        for i, item in enumerate(items):
+            if i >= len(tags) or tags[i] in self._nacked:
+                failed.append((item, False))
+            elif tags[i] in self._unconfirmed:
+                failed.append((item, True))
+            else:
+                confirmed.append(item)
+        if error is None and failed:
+            error = pika.exceptions.AMQPChannelError('broker nacked {} orders'.format(len(failed)))
+        return confirmed, failed, error
+
+    # Keep heartbeats flowing while idle, a connection found dead is
+    # dropped and reopened on the next publish.
+    def _heartbeat(self):
+        if self._conn and self._conn.is_open:
+            try:
+                self._conn.process_data_events(0)
+            except (pika.exceptions.AMQPError, OSError) as err:
+                self._logger.warning('broker connection lost while idle: {}'.format(err))
+                self._discard()
+
+    def _discard(self):
+        try:
+            if self._conn and self._conn.is_open:
+                self._conn.close()
+        except (pika.exceptions.AMQPError, OSError):
+            pass
+        self._conn = None
+        self._channel = None
+
     def _publish(self, msg, headers):
         self._channel.basic_publish(exchange=self.EXCHANGE,
                                     routing_key=self.ROUTING_KEY,
-                                    properties=pika.BasicProperties(headers=headers),
+                                    properties=pika.BasicProperties(headers=headers, message_id=msg.get('orderid')),
                                     body=json.dumps(msg).encode())
-        self._logger.info('message sent')
+        self._logger.debug('message sent')
 
     #Publish msg, reconnecting if necessary.
     def publish(self, msg, headers):
@@ -48,3 +173,250 @@ class Publisher:
             self._logger.info('closing queue connection')
             self._conn.close()
 
+
+
+class BatchPublisher(Publisher):
+    CONFIRM = True
+    QUEUE_SIZE = int(os.getenv('AMQP_QUEUE_SIZE', 10000))
+    BATCH_SIZE = int(os.getenv('AMQP_BATCH_SIZE', 100))
+    LINGER_MS = int(os.getenv('AMQP_LINGER_MS', 5))
+    # what publish() does when the queue is full
+    # block - wait up to AMQP_BLOCK_MS for space, then raise
+    # drop - log and discard the order
+    # error - raise straight away
+    # with an outbox a full queue always spills to the outbox instead
+    QUEUE_FULL = os.getenv('AMQP_QUEUE_FULL', 'block')
+    BLOCK_MS = int(os.getenv('AMQP_BLOCK_MS', 1000))
+    RETRY_MS = int(os.getenv('AMQP_RETRY_MS', 1000))
+
+    def __init__(self, logger, outbox=None):
+        super().__init__(logger)
+        self._outbox = outbox
+        self._queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._spool_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    # Start the publisher thread, or start it again if it died.
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if (self._thread is None or not self._thread.is_alive()) and not self._stopping.is_set():
+                    self._thread = threading.Thread(target=self._run, name='amqp-publisher', daemon=True)
+                    self._thread.start()
+
+    #Queue msg for the background thread, returns once it is queued.
+    def publish(self, msg, headers):
+        self._start()
+        if self._outbox is not None:
+            self._spool(msg, headers)
+            return
+        try:
+            if self.QUEUE_FULL == 'block':
+                self._queue.put((msg, headers), timeout=self.BLOCK_MS / 1000)
+            else:
+                self._queue.put_nowait((msg, headers))
+        except queue.Full:
+            DROPPED.inc()
+            if self.QUEUE_FULL == 'drop':
+                self._logger.warning('publish queue full, order dropped')
+                return
+            raise PublishQueueFull('publish queue full')
+        finally:
+            QUEUE_DEPTH.set(self._queue.qsize())
+
+    # While the outbox holds a backlog new orders go behind it to keep
+    # them in order, otherwise they are spooled only when the queue is full.
+    def _spool(self, msg, headers):
+        with self._spool_lock:
+            if not self._outbox.pending():
+                try:
+                    self._queue.put_nowait((msg, headers))
+                    QUEUE_DEPTH.set(self._queue.qsize())
+                    return
+                except queue.Full:
+                    self._logger.warning('publish queue full, spooling to outbox')
+            self._outbox.append(msg, headers)
+
+    # Move the unconfirmed (item, sent) pairs and everything queued behind
+    # them to the outbox, an order that was sent is marked redelivered.
+    def _spill(self, failed):
+        with self._spool_lock:
+            count = len(failed)
+            for (msg, headers), sent in failed:
+                self._outbox.append(msg, headers, sent)
+            while True:
+                try:
+                    msg, headers = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._outbox.append(msg, headers)
+                count += 1
+        QUEUE_DEPTH.set(self._queue.qsize())
+        self._logger.warning('spooled {} orders to outbox'.format(count))
+
+    def _next_batch(self):
+        try:
+            batch = deque([self._queue.get(timeout=0.5)])
+        except queue.Empty:
+            return None if self._stopping.is_set() else deque()
+
+        deadline = time.monotonic() + self.LINGER_MS / 1000
+        while len(batch) < self.BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        QUEUE_DEPTH.set(self._queue.qsize())
+        return batch
+
+    def _run(self):
+        batch = deque()
+        while True:
+            if not batch:
+                batch = self._next_batch()
+                if batch is None:
+                    break
+                if not batch:
+                    self._heartbeat()
+                    continue
+
+            start = time.time()
+            size = len(batch)
+            confirmed, failed, error = self._publish_confirmed(list(batch))
+            if error is not None:
+                self._logger.error('publish failed, {} of {} orders unconfirmed: {}'.format(len(failed), size, error))
+                # confirms still in flight are lost with the connection
+                self._discard()
+                lost = sum(1 for _, sent in failed if sent)
+                if lost:
+                    self._logger.warning('no confirm for {} sent orders, they may be published twice'.format(lost))
+                if self._outbox is not None:
+                    self._spill(failed)
+                    batch = deque()
+                    continue
+                batch = deque(item for item, _ in failed)
+                if self._stopping.wait(self.RETRY_MS / 1000):
+                    self._logger.error('giving up on {} orders at shutdown'.format(len(batch) + self._queue.qsize()))
+                    break
+                continue
+            batch = deque()
+            BATCH_LATENCY.observe(time.time() - start)
+            BATCH_SIZE.observe(size)
+        # the connection belongs to this thread, close it here
+        super().close()
+
+    #Flush queued orders and stop the background thread.
+    # Returns False if the thread is still running, and may still spill
+    # into the outbox.
+    def close(self, timeout=5):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                self._logger.warning('publisher still busy after {}s, leaving its connection open'.format(timeout))
+                return False
+        return True
+
+
+class OutboxReplayer(Publisher):
+    """Drains the outbox to the exchange in order over its own connection.
+
+    Each batch read is published with pipelined confirms. The orderids
+    the broker confirmed are marked delivered in the outbox, and the
+    batch is committed once all of it is confirmed. A record whose
+    orderid is already marked delivered is skipped. That covers a batch
+    retried after a partial failure and a restart before the commit.
+    An order sent without its confirm coming back, here or by
+    BatchPublisher, cannot be told apart from one the broker never got.
+    It is published again and may reach consumers twice. Those spooled
+    by BatchPublisher are counted as redelivered.
+
+    Every ADOPT_MS it also takes over outbox slots no process holds and
+    drains them after its own.
+    """
+    CONFIRM = True
+    BATCH_SIZE = int(os.getenv('OUTBOX_REPLAY_BATCH', 100))
+    RETRY_MS = int(os.getenv('AMQP_RETRY_MS', 1000))
+    ADOPT_MS = int(os.getenv('OUTBOX_ADOPT_MS', 30000))
+
+    def __init__(self, logger, outbox):
+        super().__init__(logger)
+        self._outbox = outbox
+        # slots taken over from workers that are gone
+        self._adopted = []
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='outbox-replayer', daemon=True)
+        self._thread.start()
+
+    def _adopt(self):
+        for outbox in self._outbox.orphans():
+            self._logger.warning('outbox replayer took over an orphaned slot')
+            self._adopted.append(outbox)
+
+    # Our own outbox first, then adopted ones, released once empty.
+    def _draining(self):
+        while self._adopted and not self._adopted[0].pending():
+            self._adopted.pop(0).close()
+        if self._outbox.pending() or not self._adopted:
+            return self._outbox
+        return self._adopted[0]
+
+    def _run(self):
+        next_adopt = 0
+        while not self._stopping.is_set():
+            if time.monotonic() >= next_adopt:
+                self._adopt()
+                next_adopt = time.monotonic() + self.ADOPT_MS / 1000
+            outbox = self._draining()
+            records = outbox.read(self.BATCH_SIZE)
+            if not records:
+                self._outbox.wait(0.5)
+                self._heartbeat()
+                continue
+
+            items = []
+            redelivered = 0
+            for position, msg, headers, sent in records:
+                if outbox.delivered(msg.get('orderid')):
+                    DEDUPED.inc()
+                    continue
+                items.append((msg, headers))
+                redelivered += sent
+            confirmed, failed, error = self._publish_confirmed(items)
+            outbox.mark_delivered(msg.get('orderid') for msg, _ in confirmed)
+            REPLAYED.inc(len(confirmed))
+            if error is not None:
+                self._logger.error('outbox replay failed, {} of {} orders unconfirmed: {}'.format(
+                    len(failed), len(items), error))
+                self._discard()
+                self._stopping.wait(self.RETRY_MS / 1000)
+                continue
+            REDELIVERED.inc(redelivered)
+            outbox.commit(records[-1][0], len(records))
+        # the connection belongs to this thread, close it here
+        super().close()
+
+    # With keep_outbox the own outbox is only synced and left open, for
+    # when a publisher that shares it may still be spilling into it.
+    def close(self, timeout=5, keep_outbox=False):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                self._logger.warning('outbox replayer still busy after {}s, leaving the outbox open'.format(timeout))
+                self._outbox.sync()
+                return
+        for outbox in self._adopted:
+            outbox.close()
+        if keep_outbox:
+            self._outbox.sync()
+        else:
+            self._outbox.close()
@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import logging.handlers
+
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import ConsoleSpanExporter, BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# name -> settings, each setting can be overridden from the environment
+PROFILES = {
+    # everything, synchronously, as the service used to run
+    'debug': {
+        'TRACE_SAMPLE_RATIO': 1.0,
+        'TRACE_CONSOLE': True,
+        'LOG_LEVEL': 'DEBUG',
+        'LOG_QUEUE': False,
+        'REQUEST_LOG_RATE': 0,
+        'REQUEST_LOG_SAMPLE': 1.0
+    },
+    # every trace and request log, exported off the request thread
+    'default': {
+        'TRACE_SAMPLE_RATIO': 1.0,
+        'TRACE_CONSOLE': False,
+        'LOG_LEVEL': 'INFO',
+        'LOG_QUEUE': True,
+        'REQUEST_LOG_RATE': 0,
+        'REQUEST_LOG_SAMPLE': 1.0
+    },
+    # sampled traces and request logs for high traffic
+    'lean': {
+        'TRACE_SAMPLE_RATIO': 0.1,
+        'TRACE_CONSOLE': False,
+        'LOG_LEVEL': 'INFO',
+        'LOG_QUEUE': True,
+        'REQUEST_LOG_RATE': 20,
+        'REQUEST_LOG_SAMPLE': 0.1
+    }
+}
+
+
+class Profile:
+    """Tracing and logging settings picked by TELEMETRY_PROFILE.
+
+    TRACE_SAMPLE_RATIO - share of new traces kept, child spans follow the
+        sampling decision of their parent
+    TRACE_CONSOLE - also print every span to stdout
+    LOG_LEVEL - level for the application logger
+    LOG_QUEUE - hand records to a background thread for output
+    REQUEST_LOG_RATE - max INFO and DEBUG records per second, 0 for no limit
+    REQUEST_LOG_SAMPLE - share of INFO and DEBUG records kept
+    """
+
+    def __init__(self, name=None):
+        self.name = name or os.getenv('TELEMETRY_PROFILE', 'default')
+        settings = PROFILES[self.name]
+        self.sample_ratio = float(os.getenv('TRACE_SAMPLE_RATIO', settings['TRACE_SAMPLE_RATIO']))
+        self.console = _flag('TRACE_CONSOLE', settings['TRACE_CONSOLE'])
+        self.log_level = os.getenv('LOG_LEVEL', settings['LOG_LEVEL']).upper()
+        self.log_queue = _flag('LOG_QUEUE', settings['LOG_QUEUE'])
+        self.log_rate = float(os.getenv('REQUEST_LOG_RATE', settings['REQUEST_LOG_RATE']))
+        self.log_sample = float(os.getenv('REQUEST_LOG_SAMPLE', settings['REQUEST_LOG_SAMPLE']))
+
+
+def _flag(name, default):
+    return os.getenv(name, str(default)).lower() == 'true'
+
+
+class RequestLogFilter(logging.Filter):
+    """Samples and rate limits records below WARNING.
+
+    Warnings and errors always pass. Dropped records are never formatted.
+    """
+
+    def __init__(self, rate, sample):
+        super().__init__()
+        self._rate = rate
+        self._sample = sample
+        self._lock = threading.Lock()
+        self._tokens = rate
+        self._last = time.monotonic()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        if self._sample < 1.0 and random.random() >= self._sample:
+            return False
+        if self._rate <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._rate, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def tracer_provider(profile, service, exporters, console=None):
+    sampler = ParentBased(TraceIdRatioBased(profile.sample_ratio))
+    provider = TracerProvider(sampler=sampler, resource=Resource.create({SERVICE_NAME: service}))
+    for exporter in exporters:
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+    if profile.console:
+        provider.add_span_processor(BatchSpanProcessor(ConsoleSpanExporter(out=console or sys.stdout)))
+    return provider
+
+
+# Route logger output through the profile, returns the QueueListener
+# to stop at shutdown or None when logging synchronously.
+def configure_logging(profile, logger, stream=None):
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    for old in list(logger.filters):
+        if isinstance(old, RequestLogFilter):
+            logger.removeFilter(old)
+
+    logger.setLevel(profile.log_level)
+    logger.propagate = False
+    if profile.log_rate > 0 or profile.log_sample < 1.0:
+        logger.addFilter(RequestLogFilter(profile.log_rate, profile.log_sample))
+
+    if not profile.log_queue:
+        logger.addHandler(handler)
+        return None
+    records = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class _NullExporter(SpanExporter):
+    def export(self, spans):
+        return SpanExportResult.SUCCESS
+
+
+# Per-request telemetry cost of a profile, measured on a request shaped
+# like /pay: a server span, five client spans and the usual log lines.
+def measure(profile, requests=2000):
+    logger = logging.getLogger('telemetry.bench.{}'.format(profile.name))
+    with open(os.devnull, 'w') as devnull:
+        provider = tracer_provider(profile, 'payment-bench', [_NullExporter()], devnull)
+        tracer = provider.get_tracer(__name__)
+        listener = configure_logging(profile, logger, devnull)
+        try:
+            cart = {'total': 1234, 'items': [{'sku': 'SKU{}'.format(i), 'qty': 1} for i in range(10)] +
+                                            [{'sku': 'SHIP', 'qty': 1}]}
+            start = time.perf_counter()
+            for i in range(requests):
+                with tracer.start_as_current_span('pay'):
+                    logger.info('payment for %s', i)
+                    logger.debug('cart %s', cart)
+                    for call in ('check', 'gateway', 'publish', 'order', 'cart'):
+                        with tracer.start_as_current_span(call):
+                            logger.info('%s returned %s', call, 200)
+            elapsed = time.perf_counter() - start
+            provider.force_flush()
+        finally:
+            provider.shutdown()
+            if listener is not None:
+                listener.stop()
+    return elapsed / requests * 1e6
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    results = {name: round(measure(Profile(name), count), 2) for name in PROFILES}
+    print(json.dumps({'requests': count, 'us_per_request': results}, indent=2))